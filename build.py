@@ -1,29 +1,123 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-import json, os, time
-from datetime import datetime, date
+import json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, date, timedelta
 from pathlib import Path
 import pandas as pd
 import requests
 
+try:
+    import orjson
+except ImportError:  # optional speedup, stdlib json is the fallback
+    orjson = None
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 USER_AGENT = "ballot-events-map/1.0 (contact: ndalmon@bma.org.uk)"
 CONTACT_EMAIL = "ndalmon@bma.org.uk"
 
+# Defaults respect the public Nominatim usage policy (single worker, ~1 req
+# per 1.5s). Point GEOCODE_WORKERS / GEOCODE_RPS higher for a private server.
+GEOCODE_WORKERS = max(1, int(os.environ.get("GEOCODE_WORKERS", "1")))
+GEOCODE_RPS = float(os.environ.get("GEOCODE_RPS", "0.67"))
+# Optional batch endpoint (self-hosted Nominatim/Photon front): POST every
+# unique query in one request instead of one round-trip per location.
+GEOCODE_BATCH = os.environ.get("GEOCODE_BATCH")
+
+# One session for all Nominatim calls: reuses the TCP/TLS connection instead
+# of paying a fresh handshake per lookup, and retries transient failures.
+SESSION = requests.Session()
+SESSION.headers.update({
+    "User-Agent": USER_AGENT,
+    "Accept": "application/json",
+    "Accept-Language": "en",
+})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=max(2, GEOCODE_WORKERS),
+    pool_maxsize=max(2, GEOCODE_WORKERS),
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 502, 503, 504]),
+))
+
 
 EXCEL_PATH = "events.xlsx"
 OUT_PATH = Path("data/events.json")
 CACHE_PATH = Path(".geocode_cache.json")
 
-def safe(x):
-    return "" if x is None or (isinstance(x,float) and pd.isna(x)) else str(x).strip()
+# Canonical header names and the substrings that identify them, most
+# specific first. Resolved in a single pass over each sheet's columns.
+ALIASES = {
+    "date": ("event date", "date"),
+    "location": ("event location", "venue", "location"),
+    "type": ("event type", "type"),
+    "notes": ("notes",),
+    "lead": ("lead",),
+    "lat": ("lat",),
+    "lon": ("lon",),
+}
+
+
+class RateLimiter:
+    """Enforce a minimum spacing between requests across worker threads."""
+
+    def __init__(self, per_second):
+        self.min_interval = 1.0 / per_second if per_second > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _atomic_write(path, data):
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    if isinstance(data, bytes):
+        tmp.write_bytes(data)
+    else:
+        tmp.write_text(data, encoding="utf-8")
+    os.replace(tmp, path)
 
-def parse_date(x):
-    if x is None or (isinstance(x,float) and pd.isna(x)): return None
-    dt = pd.to_datetime(x, errors="coerce", dayfirst=True)
-    return None if pd.isna(dt) else dt.date().isoformat()
+# How long a "no result" answer is trusted before the location is retried.
+NEGATIVE_TTL = timedelta(days=7)
+
+def _cache_coords(entry):
+    if isinstance(entry, dict):
+        return entry.get("lat"), entry.get("lon")
+    return tuple(entry)  # legacy [lat, lon] entries
+
+def _cache_fresh(entry):
+    lat, lon = _cache_coords(entry)
+    if lat is not None and lon is not None:
+        return True
+    # Null results expire so a later run can retry; legacy entries carry
+    # no timestamp and are retried immediately.
+    if not isinstance(entry, dict) or "ts" not in entry:
+        return False
+    ts = datetime.fromisoformat(entry["ts"].rstrip("Z"))
+    return datetime.utcnow() - ts < NEGATIVE_TTL
+
+def _json_loads(text):
+    return orjson.loads(text) if orjson else json.loads(text)
+
+def save_cache(cache):
+    if orjson:
+        # orjson emits UTF-8 bytes; write them as-is rather than decoding
+        # to str only for write_text to encode again.
+        _atomic_write(CACHE_PATH, orjson.dumps(cache, option=orjson.OPT_INDENT_2))
+    else:
+        _atomic_write(CACHE_PATH, json.dumps(cache, indent=2))
 
 def geocode(q):
-    r = requests.get(
+    """One Nominatim query: (lat, lon), or (None, None) when the service
+    definitively has no result. Network errors propagate to the caller -
+    the session adapter already retries transient failures with backoff.
+    """
+    r = SESSION.get(
         "https://nominatim.openstreetmap.org/search",
         params={
             "q": q,
@@ -31,17 +125,12 @@ def geocode(q):
             "limit": 1,
             "email": CONTACT_EMAIL,
         },
-        headers={
-            "User-Agent": USER_AGENT,
-            "Accept": "application/json",
-            "Accept-Language": "en",
-        },
         timeout=30
     )
 
-    if r.status_code in (401, 403, 418, 429):
-        return None, None
-
+    # A 401/403/418 means we were refused, not that the location doesn't
+    # exist: raise so the caller leaves the key uncached. 429 is retried by
+    # the session adapter.
     r.raise_for_status()
     j = r.json()
     if not j:
@@ -49,94 +138,201 @@ def geocode(q):
     return float(j[0]["lat"]), float(j[0]["lon"])
 
 
+def geocode_batch(queries):
+    """POST all queries to GEOCODE_BATCH at once; returns [(lat, lon), ...].
+
+    Expects a JSON array back with one {"lat": ..., "lon": ...} (or null)
+    per query, in order. Only for private backends - the public Nominatim
+    server has no batch API.
+    """
+    r = SESSION.post(GEOCODE_BATCH, json={"queries": queries, "limit": 1},
+                     timeout=120)
+    r.raise_for_status()
+    out = []
+    for hit in r.json():
+        if hit and hit.get("lat") is not None:
+            out.append((float(hit["lat"]), float(hit["lon"])))
+        else:
+            out.append((None, None))
+    return out
+
+
 def main():
     if not Path(EXCEL_PATH).exists():
         raise SystemExit("events.xlsx not found")
 
-    xls = pd.ExcelFile(EXCEL_PATH)
+    # read_only streams rows instead of building openpyxl's full cell graph,
+    # which cuts both parse time and peak memory on larger workbooks.
+    xls = pd.ExcelFile(EXCEL_PATH, engine="openpyxl",
+                       engine_kwargs={"read_only": True, "data_only": True})
     events = []
 
     for sheet in xls.sheet_names:
-        raw = pd.read_excel(EXCEL_PATH, sheet_name=sheet, header=None)
+        raw = xls.parse(sheet, header=None)
         if raw.empty:
             continue
 
+        # Lowercase the probe window once, then do one join + two C-level
+        # substring checks per candidate row.
+        probe = raw.head(15).fillna("").astype(str).apply(lambda c: c.str.lower())
         header_row = 0
-        for i in range(min(15, len(raw))):
-            row = [str(x).lower() for x in raw.iloc[i].tolist()]
-            if "event" in " ".join(row) and "location" in " ".join(row):
+        for i in range(len(probe)):
+            row_joined = " ".join(probe.iloc[i])
+            if "event" in row_joined and "location" in row_joined:
                 header_row = i
                 break
 
         df = raw.iloc[header_row+1:].copy()
-        df.columns = [safe(x) for x in raw.iloc[header_row]]
+        df.columns = raw.iloc[header_row].fillna("").astype(str).str.strip()
         df = df.dropna(how="all")
 
         cols = {c.lower(): c for c in df.columns}
-        def pick(*names):
-            for n in names:
-                for k,v in cols.items():
-                    if n.lower() in k:
-                        return v
-            return None
-
-        c_date = pick("event date")
-        c_loc  = pick("event location")
-        c_type = pick("event type")
-        c_notes= pick("notes")
-        c_lead = pick("lead")
-        c_lat  = pick("lat")
-        c_lon  = pick("lon")
-
-        for _,r in df.iterrows():
-            loc = safe(r.get(c_loc))
-            if not loc:
-                continue
-
-            lat = r.get(c_lat) if c_lat else None
-            lon = r.get(c_lon) if c_lon else None
-            lat = None if pd.isna(lat) else float(lat)
-            lon = None if pd.isna(lon) else float(lon)
-
-            events.append({
-                "region": sheet.strip(),
-                "date": parse_date(r.get(c_date)),
-                "location": loc,
-                "event_type": safe(r.get(c_type)),
-                "notes": safe(r.get(c_notes)),
-                "lead": safe(r.get(c_lead)),
-                "lat": lat,
-                "lon": lon,
-                "location_key": loc.lower().strip()
-            })
+        resolved = dict.fromkeys(ALIASES)
+        for field, aliases in ALIASES.items():
+            # alias order is the priority: a specific name like "event date"
+            # beats any column a looser alias would also match
+            resolved[field] = next(
+                (orig for a in aliases for lc, orig in cols.items() if a in lc),
+                None)
+
+        c_date = resolved["date"]
+        c_loc  = resolved["location"]
+        c_type = resolved["type"]
+        c_notes= resolved["notes"]
+        c_lead = resolved["lead"]
+        c_lat  = resolved["lat"]
+        c_lon  = resolved["lon"]
+
+        if not c_loc:
+            continue
+
+        # Build all columns vectorized instead of per-row iterrows work.
+        def col_str(c):
+            if not c:
+                return pd.Series("", index=df.index)
+            return df[c].where(df[c].notna(), "").astype(str).str.strip()
+
+        out = pd.DataFrame(index=df.index)
+        out["region"] = sheet.strip()
+        if c_date:
+            dt = pd.to_datetime(df[c_date], errors="coerce", dayfirst=True)
+            out["date"] = dt.dt.date.astype(str).astype(object).where(dt.notna(), None)
+        else:
+            out["date"] = None
+        out["location"] = col_str(c_loc)
+        out["event_type"] = col_str(c_type)
+        out["notes"] = col_str(c_notes)
+        out["lead"] = col_str(c_lead)
+        def col_num(c):
+            if not c:
+                return None
+            # tolist() yields plain Python floats. The Series must be object
+            # dtype: assigning a bare list would re-infer float64 and coerce
+            # the Nones back to NaN, which breaks the lat-is-None geocode
+            # check and leaks NaN into the JSON output.
+            vals = pd.to_numeric(df[c], errors="coerce").to_numpy().tolist()
+            return pd.Series([None if pd.isna(v) else v for v in vals],
+                             index=df.index, dtype=object)
+
+        out["lat"] = col_num(c_lat)
+        out["lon"] = col_num(c_lon)
+        out["location_key"] = out["location"].str.lower()
+        out = out[out["location"] != ""]
+        events.extend(out.to_dict(orient="records"))
 
     cache = {}
     if CACHE_PATH.exists():
-        cache = json.loads(CACHE_PATH.read_text())
+        cache = _json_loads(CACHE_PATH.read_text())
 
+    # Group events by normalized location so each unique location is looked
+    # up once and the result written back to every matching event.
+    unique = {}
+    unique_to_events = {}
     for e in events:
         if e["lat"] is None or e["lon"] is None:
-            key = e["location_key"]
-            if key in cache:
-                e["lat"], e["lon"] = cache[key]
-            else:
-                lat, lon = geocode(f"{e['location']}, United Kingdom")
-                cache[key] = (lat, lon)
-                e["lat"], e["lon"] = lat, lon
-                time.sleep(1.5)
-
-    CACHE_PATH.write_text(json.dumps(cache, indent=2))
-
-    payload = {
-        "meta": {
-            "generated_at": datetime.utcnow().isoformat()+"Z",
-            "event_count": len(events)
-        },
-        "events": events
+            k = e["location_key"]
+            unique.setdefault(k, e["location"])
+            unique_to_events.setdefault(k, []).append(e)
+
+    limiter = RateLimiter(GEOCODE_RPS)
+
+    def fetch(k, loc):
+        limiter.wait()
+        try:
+            lat, lon = geocode(f"{loc}, United Kingdom")
+            if lat is None:
+                # Definitive empty result: retry once without the country
+                # bias before giving up on the location.
+                limiter.wait()
+                lat, lon = geocode(loc)
+        except requests.RequestException:
+            # Transient failure: leave the key uncached so the next run
+            # retries it, instead of storing a bogus "no result".
+            return k, None
+        return k, (lat, lon)
+
+    pending = {k: loc for k, loc in unique.items()
+               if k not in cache or not _cache_fresh(cache[k])}
+
+    if pending and GEOCODE_BATCH:
+        keys = list(pending)
+        try:
+            results = geocode_batch([f"{pending[k]}, United Kingdom" for k in keys])
+        except requests.RequestException:
+            pass  # fall through to the per-location path
+        else:
+            now = datetime.utcnow().isoformat() + "Z"
+            for k, (lat, lon) in zip(keys, results):
+                cache[k] = {"lat": lat, "lon": lon, "ts": now}
+            save_cache(cache)
+            pending = {}
+
+    # Persist the cache as lookups land so a crash mid-run doesn't throw
+    # away geocodes we already paid rate-limited requests for.
+    try:
+        with ThreadPoolExecutor(max_workers=GEOCODE_WORKERS) as pool:
+            futures = [pool.submit(fetch, k, loc) for k, loc in pending.items()]
+            for n, fut in enumerate(as_completed(futures), 1):
+                # cache writes stay in the main thread
+                k, result = fut.result()
+                if result is None:
+                    continue
+                lat, lon = result
+                cache[k] = {"lat": lat, "lon": lon,
+                            "ts": datetime.utcnow().isoformat() + "Z"}
+                if n % 10 == 0:
+                    save_cache(cache)
+    finally:
+        if pending:
+            save_cache(cache)
+
+    for k in unique:
+        if k not in cache:
+            continue  # lookup failed this run; events keep null coords
+        lat, lon = _cache_coords(cache[k])
+        for e in unique_to_events[k]:
+            e["lat"], e["lon"] = lat, lon
+
+    meta = {
+        "generated_at": datetime.utcnow().isoformat()+"Z",
+        "event_count": len(events)
     }
 
     OUT_PATH.parent.mkdir(exist_ok=True)
-    OUT_PATH.write_text(json.dumps(payload, indent=2))
+    # Compact output: the file is only read by the map JS, so whitespace is
+    # pure download weight. Events are serialized one at a time so we never
+    # hold the whole document as a second in-memory string.
+    if orjson:
+        dumps = orjson.dumps
+    else:
+        dumps = lambda o: json.dumps(o, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    with OUT_PATH.open("wb") as f:
+        f.write(b'{"meta":' + dumps(meta) + b',"events":[')
+        for i, e in enumerate(events):
+            if i:
+                f.write(b",")
+            f.write(dumps(e))
+        f.write(b"]}")
     print(f"Wrote {OUT_PATH}")
 
 if __name__ == "__main__":